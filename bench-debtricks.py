@@ -0,0 +1,399 @@
+#!/usr/bin/env python3
+"""
+Offline benchmarks for debtricks.archive
+
+Serves a synthetic Debian archive (Release signed with a throwaway gpg key,
+installer SHA256SUMS, large Packages.xz) from a local HTTP server,
+and times the hot paths of Archive against it.  No network access needed.
+
+Results may be saved with --json and compared against a previous run
+with --baseline to report trends.  In CI, keep the JSON from the last
+run on the main branch as the baseline, eg.
+
+  python3 bench-debtricks.py --json bench.json \\
+      --baseline bench-main.json --max-slowdown 25
+
+which exits non-zero if any median is more than 25% slower.  Also run
+"python3 bench-debtricks.py --check" to check the cache handling of Archive.  The results
+table goes to stdout, logging (gpg output at -l DEBUG) to stderr.
+"""
+
+import logging
+_log = logging.getLogger(__name__)
+
+import os, sys, json, time, lzma, hashlib
+import subprocess
+import threading
+import tracemalloc
+from statistics import median
+from functools import partial
+from tempfile import TemporaryDirectory
+from urllib.parse import urlsplit
+from http.server import ThreadingHTTPServer, SimpleHTTPRequestHandler
+
+from debtricks import archive
+from debtricks.archive import Archive
+
+RELEASE = 'bench'
+ARCH = 'amd64'
+INSTALLER = 'main/installer-%s/current/images/'%ARCH
+NETBOOT = 'netboot/debian-installer/%s/'%ARCH
+
+def getargs():
+    import argparse
+    def lvl(name):
+        L = logging.getLevelName(name)
+        if type(L)!=int:
+            raise argparse.ArgumentTypeError('invalid log level %s'%L)
+        return L
+
+    P = argparse.ArgumentParser(description='Benchmark debtricks against a local synthetic archive')
+    P.add_argument('-n','--repeat',metavar='NUM',type=int,default=5,help='Iterations per benchmark')
+    P.add_argument('--packages',metavar='NUM',type=int,default=20000,help='Entries in Packages.xz')
+    P.add_argument('--blob-size',metavar='MB',type=int,default=16,help='Size of installer kernel/initrd')
+    P.add_argument('--json',metavar='FILE',help='Write results to file')
+    P.add_argument('--baseline',metavar='FILE',help='Compare with results of a previous run')
+    P.add_argument('--max-slowdown',metavar='PCT',type=float,
+                   help='Exit with error if any benchmark is slower than baseline by more than this')
+    P.add_argument('--check', action='store_true',
+                   help='Check cache behaviour of Archive instead of timing')
+    P.add_argument('-l','--lvl',metavar='NAME',default='WARN',help='python log level', type=lvl)
+    return P.parse_args()
+
+def sha256(content):
+    return hashlib.sha256(content).hexdigest()
+
+def gen_packages(num):
+    ret = []
+    for i in range(num):
+        name = 'pkg%05d'%i
+        ret.append(("Package: %(name)s\n"
+                    "Version: 1.%(i)d-1\n"
+                    "Installed-Size: %(i)d\n"
+                    "Maintainer: Nobody <nobody@localhost>\n"
+                    "Architecture: %(arch)s\n"
+                    "Depends: libc6 (>= 2.36), pkg%(dep)05d\n"
+                    "Description: Synthetic package %(i)d\n"
+                    "Homepage: http://localhost/%(name)s\n"
+                    "Section: misc\n"
+                    "Priority: optional\n"
+                    "Filename: pool/main/p/%(name)s/%(name)s_1.%(i)d-1_%(arch)s.deb\n"
+                    "Size: %(i)d\n"
+                    "SHA256: %(hash)s\n"
+                    "\n")%{'name':name, 'i':i, 'dep':(i*7)%num, 'arch':ARCH,
+                           'hash':sha256(name.encode())})
+    return ''.join(ret).encode()
+
+class Mirror(object):
+    """Synthetic archive under a temporary directory
+    """
+    def __init__(self, root, npkgs, blobsize):
+        self.root = root
+        self.dist = os.path.join(root, 'dists', RELEASE)
+        self.gnupghome = os.path.join(root, 'gnupg')
+        self.keyring = os.path.join(root, 'bench.asc')
+
+        self.blobsize = blobsize
+        self.files = {}
+        self.files['main/binary-%s/Packages.xz'%ARCH] = lzma.compress(gen_packages(npkgs))
+
+        try:
+            self.gpg('--quick-generate-key', 'debtricks bench <bench@localhost>', 'ed25519', 'sign', 'never')
+            with open(self.keyring, 'wb') as F:
+                F.write(self.gpg('--armor', '--export'))
+            self.update_installer()
+        except:
+            self.close()
+            raise
+
+    def update_installer(self):
+        """(Re)generate installer images, and publish a new Release
+        """
+        for name in ('linux', 'initrd.gz'):
+            self.files[INSTALLER+NETBOOT+name] = os.urandom(self.blobsize)
+
+        self.files[INSTALLER+'SHA256SUMS'] = ''.join(['%s  ./%s\n'%(sha256(content), name[len(INSTALLER):])
+                                                     for name, content in self.files.items()
+                                                     if name.startswith(INSTALLER+NETBOOT)]).encode()
+        self.publish()
+
+    def publish(self):
+        for name, content in self.files.items():
+            self.write(name, content)
+
+        release = ["Origin: Debian\n",
+                   "Label: Debian\n",
+                   "Suite: %s\n"%RELEASE,
+                   "Codename: %s\n"%RELEASE,
+                   "Date: %s\n"%time.strftime('%a, %d %b %Y %H:%M:%S UTC', time.gmtime()),
+                   "Architectures: %s\n"%ARCH,
+                   "Components: main\n",
+                   "SHA256:\n"]
+        for name, content in sorted(self.files.items()):
+            release.append(" %s %16d %s\n"%(sha256(content), len(content), name))
+        self.write('Release', ''.join(release).encode())
+
+        self.gpg('--yes', '--armor', '--detach-sign', '--output', os.path.join(self.dist, 'Release.gpg'),
+                 os.path.join(self.dist, 'Release'))
+
+    def close(self):
+        """Stop the gpg-agent started for key generation and signing
+        """
+        env = os.environ.copy()
+        env['GNUPGHOME'] = self.gnupghome
+        subprocess.call(['gpgconf', '--kill', 'gpg-agent'], env=env)
+
+    def write(self, name, content):
+        fname = os.path.join(self.dist, name)
+        os.makedirs(os.path.dirname(fname), exist_ok=True)
+        with open(fname, 'wb') as F:
+            F.write(content)
+
+    def gpg(self, *args):
+        os.makedirs(self.gnupghome, mode=0o700, exist_ok=True)
+        env = os.environ.copy()
+        env['GNUPGHOME'] = self.gnupghome
+        return subprocess.check_output(archive.GPG[:1]+['--batch', '--pinentry-mode', 'loopback', '--passphrase', '']+list(args),
+                                       env=env, stderr=subprocess.DEVNULL)
+
+class Server(object):
+    """Serve a directory on a random localhost port
+    """
+    class Handler(SimpleHTTPRequestHandler):
+        def do_GET(self):
+            self.server.requests.append(urlsplit(self.path).path)
+            SimpleHTTPRequestHandler.do_GET(self)
+        def translate_path(self, path):
+            # accept absolute-form request target, as real mirrors do
+            return SimpleHTTPRequestHandler.translate_path(self, urlsplit(path).path)
+        def log_message(self, *args):
+            pass
+
+    def __init__(self, root):
+        self.httpd = ThreadingHTTPServer(('127.0.0.1', 0), partial(self.Handler, directory=root))
+        self.httpd.requests = self.requests = []
+        self.url = 'http://127.0.0.1:%d/'%self.httpd.server_address[1]
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def __enter__(self):
+        self.thread.start()
+        return self
+    def __exit__(self, A, B, C):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+def timeit(func, repeat, setup=None):
+    T = []
+    for _n in range(repeat):
+        if setup:
+            setup()
+        T0 = time.perf_counter()
+        func()
+        T.append(time.perf_counter()-T0)
+    return {'min':min(T), 'median':median(T), 'max':max(T)}
+
+def clear_cache(cachedir):
+    for name in os.listdir(cachedir):
+        os.remove(os.path.join(cachedir, name))
+
+def run(args, D):
+    _log.info('Generating archive')
+    M = Mirror(os.path.join(D, 'mirror'), args.packages, args.blob_size<<20)
+    try:
+        archive.KEYRINGS = [M.keyring]
+        cachedir = os.path.join(D, 'cache')
+        results = {}
+
+        with Server(M.root) as S:
+            distro = S.url+'dists/'+RELEASE
+
+            with open(os.path.join(M.dist, 'Release'), 'rb') as F:
+                release = F.read()
+            with open(os.path.join(M.dist, 'Release.gpg'), 'rb') as F:
+                release_gpg = F.read()
+            results['gpg_verify'] = timeit(lambda:archive.gpg_verify(release, release_gpg), args.repeat)
+
+            results['Archive.__init__'] = timeit(lambda:Archive(distro, cachedir=cachedir), args.repeat)
+            results['Archive.__init__ insecure'] = timeit(lambda:Archive(distro, cachedir=cachedir, secure=False),
+                                                          args.repeat)
+
+            A = Archive(distro, cachedir=cachedir)
+            def clear_sums():
+                for name in os.listdir(cachedir):
+                    if name.endswith('_SHA256SUMS'):
+                        os.remove(os.path.join(cachedir, name))
+            results['installer cold'] = timeit(lambda:A.installer(ARCH), args.repeat, setup=clear_sums)
+            results['installer warm'] = timeit(lambda:A.installer(ARCH), args.repeat,
+                                               setup=partial(A.installer, ARCH))
+
+            I = A.installer(ARCH).cd(NETBOOT)
+            def getfile():
+                with I.getfile('initrd.gz') as F:
+                    assert F.seek(0, 2)==args.blob_size<<20
+            results['getfile cold'] = timeit(getfile, args.repeat, setup=partial(clear_cache, cachedir))
+            results['getfile warm'] = timeit(getfile, args.repeat)
+
+            # getfile cold cleared the cached Release and SHA256SUMS
+            Archive(distro, cachedir=cachedir).installer(ARCH)
+            # startup with a cached Release: gpg check, but no fetch
+            results['Archive.__init__ cached'] = timeit(lambda:Archive(distro, cachedir=cachedir, maxage=1e9),
+                                                        args.repeat)
+            def offline():
+                I = Archive(distro, cachedir=cachedir, lazy=True, offline=True).installer(ARCH).cd(NETBOOT)
+                with I.getfile('initrd.gz') as F:
+                    assert F.seek(0, 2)==args.blob_size<<20
+            results['offline installer getfile'] = timeit(offline, args.repeat)
+
+            def section():
+                assert len(A.section(ARCH, 'main'))==args.packages
+            results['section'] = timeit(section, args.repeat)
+            tracemalloc.start()
+            try:
+                section()
+                results['section']['peak_bytes'] = tracemalloc.get_traced_memory()[1]
+            finally:
+                tracemalloc.stop()
+    finally:
+        M.close()
+
+    return results
+
+def check(D):
+    """Check handling of cachedir against a small mirror
+    """
+    M = Mirror(os.path.join(D, 'mirror'), 100, 4096)
+    try:
+        archive.KEYRINGS = [M.keyring]
+        cachedir = os.path.join(D, 'cache')
+        os.mkdir(cachedir)
+
+        with Server(M.root) as S:
+            distro = S.url+'dists/'+RELEASE
+            def releases():
+                N = S.requests.count('/dists/%s/Release'%RELEASE)
+                del S.requests[:]
+                return N
+            def linux(**kws):
+                I = Archive(distro, cachedir=cachedir, **kws).installer(ARCH).cd(NETBOOT)
+                with I.getfile('linux') as F:
+                    assert F.read()==M.files[INSTALLER+NETBOOT+'linux']
+
+            # offline with empty cache fails, and leaves nothing behind
+            try:
+                Archive(distro, cachedir=cachedir, offline=True)
+                assert False, 'offline without cache should fail'
+            except RuntimeError:
+                pass
+            assert os.listdir(cachedir)==[], os.listdir(cachedir)
+
+            linux()
+            assert releases()==1
+            linux(maxage=3600)
+            assert releases()==0, 'Release re-fetched within maxage'
+            print('ok - re-use cached Release within maxage')
+
+            # offline cache miss leaves no empty file
+            before = set(os.listdir(cachedir))
+            try:
+                Archive(distro, cachedir=cachedir, offline=True).installer('i386')
+                assert False, 'offline cache miss should fail'
+            except (RuntimeError, KeyError):
+                pass
+            A = Archive(distro, cachedir=cachedir, offline=True, secure=False)
+            try:
+                A._top.getfile('main/binary-%s/Packages.xz'%ARCH)
+                assert False, 'offline cache miss should fail'
+            except RuntimeError:
+                pass
+            assert set(os.listdir(cachedir))==before, set(os.listdir(cachedir))-before
+            print('ok - offline cache miss leaves no file')
+
+            # insecure fetch does not replace cached Release
+            relfile = [os.path.join(cachedir, name) for name in before if name.endswith('_Release')][0]
+            with open(relfile, 'rb') as F:
+                cached = F.read()
+            M.update_installer()
+            Archive(distro, cachedir=cachedir, secure=False)
+            with open(relfile, 'rb') as F:
+                assert F.read()==cached
+            print('ok - insecure fetch does not replace cached Release')
+
+            # cached Release is now stale.  Files not yet cached fail
+            # their hash check, which re-fetches Release.
+            def uncache(*suffixes):
+                for name in os.listdir(cachedir):
+                    if name.endswith(suffixes):
+                        os.remove(os.path.join(cachedir, name))
+            releases()
+            uncache('_SHA256SUMS', '_linux')
+            linux(maxage=3600)
+            assert releases()==1
+            M.update_installer()
+            uncache('_linux')
+            linux(maxage=3600)
+            assert releases()==1
+            print('ok - stale cached Release re-fetched')
+
+            # cached Release fails verification, re-fetched
+            with open(relfile, 'ab') as F:
+                F.write(b'X-Corrupt: yes\n')
+            linux(maxage=3600)
+            assert releases()==1
+            linux(offline=True)
+            print('ok - corrupt cached Release re-fetched')
+    finally:
+        M.close()
+
+def report(results, baseline, maxslow):
+    ok = True
+    print('%-28s %10s %10s %10s %10s'%('benchmark', 'min', 'median', 'max', 'change'))
+    for name, R in results.items():
+        change = ''
+        B = baseline.get(name)
+        if B:
+            pct = 100.0*(R['median']-B['median'])/B['median']
+            change = '%+.1f%%'%pct
+            if maxslow is not None and pct>maxslow:
+                change += ' !'
+                ok = False
+        print('%-28s %9.4fs %9.4fs %9.4fs %10s'%(name, R['min'], R['median'], R['max'], change))
+        if 'peak_bytes' in R:
+            change = ''
+            if B and B.get('peak_bytes'):
+                change = '%+.1f%%'%(100.0*(R['peak_bytes']-B['peak_bytes'])/B['peak_bytes'])
+            print('%-28s %9.1fM %32s'%(name+' peak memory', R['peak_bytes']/(1<<20), change))
+    return ok
+
+def main(args):
+    if args.check:
+        with TemporaryDirectory() as D:
+            check(D)
+        return
+
+    with TemporaryDirectory() as D:
+        results = run(args, D)
+
+    baseline = {}
+    if args.baseline:
+        with open(args.baseline, 'r') as F:
+            baseline = json.load(F)['results']
+
+    ok = report(results, baseline, args.max_slowdown)
+
+    if args.json:
+        with open(args.json, 'w') as F:
+            json.dump({
+                'time':time.time(),
+                'python':sys.version,
+                'args':{'repeat':args.repeat, 'packages':args.packages, 'blob_size':args.blob_size},
+                'results':results,
+            }, F, indent=2)
+
+    if not ok:
+        _log.error('Slowdown exceeds %s%%', args.max_slowdown)
+        sys.exit(1)
+
+if __name__=='__main__':
+    A = getargs()
+    logging.basicConfig(level=A.lvl)
+    main(A)
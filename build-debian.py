@@ -40,6 +40,10 @@ def getargs():
     P.add_argument('--baseurl',metavar='URL',default='http://ftp.us.debian.org/debian/dists/')
     P.add_argument('-l','--lvl',metavar='NAME',default='INFO',help='python log level', type=lvl)
     P.add_argument('--insecure', default=True, action='store_false')
+    P.add_argument('--offline', action='store_true',
+                   help='Use only previously verified files from local cache')
+    P.add_argument('--max-age',metavar='SEC',type=float,default=0,
+                   help='Re-use cached Release if younger than this.  Default 0, always fetch')
     return P.parse_args()
 
 # arch. name mapping from debian to qemu conventions
@@ -75,14 +79,16 @@ class Builder(object):
         if args.dist.find(':')!=-1:
             # ubuntu doesn't include images in main archive listing anymore :(
             os, _, args.dist = args.dist.partition(':')
-            arch = Archive(os, args.dist+'-updates', secure=args.insecure)
+            arch = Archive(os, args.dist+'-updates', secure=args.insecure,
+                           maxage=args.max_age, offline=args.offline)
             installer = arch.installer(self.arch)
             if self.arch in ['i386','amd64']:
                 self.fetch = installer.cd('netboot/ubuntu-installer/%s/'%self.arch)
             else:
                 raise RuntimeError("Unsupported arch "+self.arch)
         else:
-            arch = Archive('debian', args.dist, secure=args.insecure)
+            arch = Archive('debian', args.dist, secure=args.insecure,
+                           maxage=args.max_age, offline=args.offline)
             installer = arch.installer(self.arch)
             if self.arch in ['i386','amd64']:
                 self.fetch = installer.cd('netboot/debian-installer/%s/'%self.arch)
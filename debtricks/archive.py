@@ -5,34 +5,52 @@ import logging
 _log = logging.getLogger(__name__)
 
 import os, sys, hashlib, stat, time
+import gzip, lzma, bz2
 from glob import glob
 import subprocess
-from tempfile import TemporaryDirectory, SpooledTemporaryFile
+from tempfile import TemporaryDirectory, TemporaryFile, SpooledTemporaryFile
 from collections import defaultdict
 from shutil import copyfileobj
 from shlex import quote as shq
 
-from urllib3 import connection_from_url
-
-from debian.deb822 import Release, Packages
+# urllib3 and debian.deb822 are imported on first use
 
 GPG=['/usr/bin/gpg','--no-autostart']
 # trusted keys for repo Release.gpg
 KEYRINGS=glob('/etc/apt/trusted.gpg.d/*.asc')
 # section names in Release
 HASHS=['SHA1','SHA256']
+# decompressors by file suffix
+DECOMP={
+    '.gz':gzip.open,
+    '.xz':lzma.open,
+    '.bz2':bz2.open,
+}
 
 __all__ = [
     'Archive',
 ]
 
+def _run(args, **kws):
+    """Run command, capturing stderr.
+    Logged at debug level, or as error on failure.
+    """
+    _log.debug("CALL %s", ' '.join([shq(a) for a in args]))
+    P = subprocess.run(args, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kws)
+    err = P.stderr.decode(errors='replace').rstrip()
+    if P.returncode:
+        _log.error("%s failed:\n%s", args[0], err)
+        raise subprocess.CalledProcessError(P.returncode, args, P.stdout, P.stderr)
+    elif err:
+        _log.debug("%s", err)
+    return P.stdout
+
 def check_call(args, **kws):
-    print("CALL", ' '.join([shq(a) for a in args]))
-    return subprocess.check_call(args, **kws)
+    _run(args, **kws)
+    return 0
 
 def check_output(args, **kws):
-    print("CALL", ' '.join([shq(a) for a in args]))
-    return subprocess.check_output(args, **kws)
+    return _run(args, **kws)
 
 def gpg_mangle_trust(content):
     ret = []
@@ -61,13 +79,13 @@ def gpg_verify(content, sig):
         with open(sfile,'wb') as F:
             F.write(sig)
 
-        print('keys')
-        trust = gpg_mangle_trust(check_output(GPG+['--export-ownertrust']))
+        trust = gpg_mangle_trust(check_output(GPG+['--export-ownertrust'], env=env))
         tfile = os.path.join(D,'trust')
         with open(tfile,'wb') as F:
             F.write(trust)
-        check_call(GPG+['--import-ownertrust',tfile])
-        print('trust',check_output(GPG+['--export-ownertrust']))
+        check_call(GPG+['--import-ownertrust',tfile], env=env)
+        if _log.isEnabledFor(logging.DEBUG):
+            _log.debug('trust %s', check_output(GPG+['--export-ownertrust'], env=env))
 # ,'--trust-model','always'
         check_call(GPG+['--verify',sfile,cfile], env=env)
 
@@ -84,6 +102,9 @@ def proc_release(rel):
 
     return info
 
+class HashMismatch(RuntimeError):
+    pass
+
 class SubManifest(object):
     def __init__(self, M, path):
         self._man, self._path = M, path
@@ -98,9 +119,11 @@ class SubManifest(object):
 
 class Manifest(object):
     SubManifest = SubManifest
-    def __init__(self, arch, info, path, secure=True):
+    def __init__(self, arch, info, path, secure=True, reload=None):
         self.arch, self._info, self.path = arch, info, path
         self.secure = secure
+        # called on hash mismatch.  returns new info, or None
+        self._reload = reload
     def cd(self, subdir):
         return self.SubManifest(self, subdir)
     def __contains__(self, key):
@@ -127,10 +150,20 @@ class Manifest(object):
         if self.secure:
             hashme.update(content)
             if self.secure and hashme.hexdigest()!=expect:
-                raise RuntimeError("Hash mismatch for '%s' %s != %s"%(fname, hashme.hexdigest(),expect))
+                raise HashMismatch("Hash mismatch for '%s' %s != %s"%(fname, hashme.hexdigest(),expect))
         return content
 
     def getfile(self, path):
+        try:
+            return self._getfile(path)
+        except HashMismatch:
+            info = self._reload and self._reload()
+            if not info:
+                raise
+            self._info = info
+            return self._getfile(path)
+
+    def _getfile(self, path):
         I = self._info[path]
         fname = self.path+I['name']
         hashme = None
@@ -141,8 +174,9 @@ class Manifest(object):
                 hashme = H # hash name (eg. 'sha256')
         if hashme is None:
             raise RuntimeError("No hash information for '%s'"%(fname))
+        size = I.get('size')
         content = self.arch.getfile(fname, hash=hashme, expect=expect,
-                                    size=I.get('size'))
+                                    size=None if size is None else int(size))
         return content
     def __repr__(self):
         return 'Manifest(url="%s")'%(self._man.path,)
@@ -164,17 +198,29 @@ class Archive(object):
     >>> F.seek(0,2)>0
     True
     >>> F.close()
+
+    With lazy=True, Release is not loaded until first needed.
+    A verified Release kept in cachedir is re-used, without network access,
+    if younger than maxage seconds, and re-fetched if a file listed in it then
+    fails its hash check.  With offline=True the network is never
+    used, and only previously verified files in cachedir are available.
     """
     cachedir = os.path.expanduser('~/.cache/debtricks/')
     region = 'us'
+    # max. age (seconds) of cached Release to use without re-fetching
+    maxage = 0
     _urls = {
         'debian':'http://ftp.%(region)s.debian.org/debian/dists/%(release)s/',
         'ubuntu':'http://archive.ubuntu.com/ubuntu/dists/%(release)s/',
     }
     Manifest = Manifest
-    def __init__(self, distro=None, release=None, cachedir=None, secure=True):
+    def __init__(self, distro=None, release=None, cachedir=None, secure=True,
+                 lazy=False, maxage=None, offline=False):
         if cachedir:
             self.cachedir = cachedir
+        if maxage is not None:
+            self.maxage = maxage
+        self.secure, self.offline = secure, offline
         os.makedirs(self.cachedir, exist_ok=True)
 
         self._parts = {'region':self.region, 'distro':distro, 'release':release}
@@ -185,26 +231,120 @@ class Archive(object):
             base = base+'/'
         self.baseurl = base%self._parts
 
-        self._pool =  connection_from_url(self.baseurl)
         self._etag = {}
         self._content = {}
 
-        release = self.get('Release')
-        if secure:
-            release_gpg = self.get('Release.gpg')
-            gpg_verify(release, release_gpg)
+        self._pool = None
+        self._release = None
+        # True when Release was loaded from cachedir
+        self._cached = False
+        if not lazy:
+            self._ensure_release()
+
+    @property
+    def release(self):
+        self._ensure_release()
+        return self._release
+    @property
+    def codename(self):
+        self._ensure_release()
+        return self._codename
+    @property
+    def archs(self):
+        self._ensure_release()
+        return self._archs
+    @property
+    def components(self):
+        self._ensure_release()
+        return self._components
+
+    def _ensure_release(self):
+        if self._release is None:
+            self._load_release()
+
+    def _getpool(self):
+        if self.offline:
+            raise RuntimeError("Offline, unable to access %s"%self.baseurl)
+        elif self._pool is None:
+            from urllib3 import connection_from_url
+            self._pool = connection_from_url(self.baseurl)
+        return self._pool
+
+    def _cachefile(self, src):
+        return os.path.join(self.cachedir, (self.baseurl+src).replace('/','_'))
+
+    def _load_release(self, refetch=False):
+        """Load Release from cache if fresh enough, or fetch.
+        Verify signature in either case.
+        """
+        from debian.deb822 import Release
+
+        relfile, sigfile = self._cachefile('Release'), self._cachefile('Release.gpg')
+        try:
+            age = time.time()-os.stat(relfile).st_mtime
+        except FileNotFoundError:
+            age = None
+
+        release = release_gpg = None
+        if not refetch and age is not None and (self.offline or age < self.maxage):
+            try:
+                with open(relfile, 'rb') as F:
+                    release = F.read()
+                if self.secure:
+                    with open(sigfile, 'rb') as F:
+                        release_gpg = F.read()
+            except FileNotFoundError:
+                release = None
+
+        if release is None and self.offline:
+            raise RuntimeError("No cached Release for %s, unable to continue offline"%self.baseurl)
+
+        if release is not None and self.secure:
+            try:
+                gpg_verify(release, release_gpg)
+            except subprocess.CalledProcessError:
+                if self.offline:
+                    raise
+                _log.warn('Cached %sRelease fails verification, re-fetching', self.baseurl)
+                release = None
+
+        self._cached = release is not None
+        if self._cached:
+            _log.info('Using cached %sRelease', self.baseurl)
         else:
-            _log.warn('Skipping signature check of RELEASE')
+            release = self.get('Release')
+            if self.secure:
+                release_gpg = self.get('Release.gpg')
+                gpg_verify(release, release_gpg)
+                # only keep verified pairs
+                for fname, content in ((relfile, release), (sigfile, release_gpg)):
+                    with open(fname+'.tmp', 'wb') as F:
+                        F.write(content)
+                for fname in (relfile, sigfile):
+                    os.replace(fname+'.tmp', fname)
+            else:
+                _log.warn('Skipping signature check of RELEASE')
 
-        release = self.release = Release(release)
+        release = self._release = Release(release)
 
-        self.codename = release['Codename']
-        self.archs = set(release['Architectures'].split())
-        self.components = set(release['Components'].split())
+        self._codename = release['Codename']
+        self._archs = set(release['Architectures'].split())
+        self._components = set(release['Components'].split())
 
         info = proc_release(release)
 
-        self._top = self.Manifest(self, info, '', secure=secure)
+        self._top = self.Manifest(self, info, '', secure=self.secure,
+                                  reload=lambda:self._refresh() and self._top._info)
+
+    def _refresh(self):
+        """Re-fetch a Release which was loaded from cache, after a hash mismatch
+        suggests that it is out of date.  Returns True if re-fetched.
+        """
+        if not self._cached or self.offline:
+            return False
+        _log.warn('Cached %sRelease is out of date, re-fetching (see maxage)', self.baseurl)
+        self._load_release(refetch=True)
+        return True
 
     def get(self, src):
         """Fetch file and return content as string.
@@ -217,7 +357,7 @@ class Archive(object):
             assert src in self._content
             headers['If-Match'] = etag
         if True:
-            R = self._pool.request('GET', url, headers=headers)
+            R = self._getpool().request('GET', url, headers=headers)
             _log.debug('Fetch %s with %s -> %d', url, headers, R.status)
             if R.status==304:
                 return self._content[src]
@@ -238,18 +378,21 @@ class Archive(object):
         """
         url = self.baseurl+src
         headers = {}
-        cachefile = os.path.join(self.cachedir, url.replace('/','_'))
+        cachefile = self._cachefile(src)
         try:
             F = open(cachefile, 'r+b')
         except FileNotFoundError:
+            if self.offline:
+                raise RuntimeError("%s not cached, unable to fetch offline"%url)
             F = open(cachefile, 'w+b')
         else:
             try:
                 H = hashlib.new(hash)
                 for chunk in iter(lambda:F.read(16384), b''):
                     H.update(chunk)
+                fsize = F.tell()
                 F.seek(0)
-                if H.hexdigest()==expect and (size is None or size==F.tell()):
+                if H.hexdigest()==expect and (size is None or size==fsize):
                     _log.info('Cache hit for %s', url)
                     return F
                 else:
@@ -259,10 +402,12 @@ class Archive(object):
                 raise
 
         try:
+            if self.offline:
+                raise RuntimeError("%s not cached, unable to fetch offline"%url)
             F.truncate(0)
             H = hashlib.new(hash)
 
-            with self._pool.request('GET', url, headers={}, preload_content=False) as R:
+            with self._getpool().request('GET', url, headers={}, preload_content=False) as R:
                 if R.status!=200:
                     raise RuntimeError("Failed to fetch %s"%url)
                 for chunk in R.stream(16384):
@@ -273,22 +418,35 @@ class Archive(object):
                 F.seek(0)
                 _log.info('Fetch complete for %s', url)
                 return F
+            raise HashMismatch("Hash mismatch for '%s'"%url)
         except:
             F.close()
             raise
 
     def installer(self, arch, rev='current'):
         prefix = "main/installer-%s/%s/images/"%(arch, rev)
-        M = self._top.get(prefix+"SHA256SUMS").decode('ascii')
+        return self.Manifest(self, self._installer_info(prefix), prefix,
+                             reload=lambda:self._refresh() and self._installer_info(prefix))
+
+    def _installer_info(self, prefix):
+        self._ensure_release()
+        if prefix+"SHA256SUMS" in self._top:
+            # through the cache so that offline use is possible
+            with self._top.getfile(prefix+"SHA256SUMS") as F:
+                M = F.read().decode('ascii')
+        else:
+            M = self._top.get(prefix+"SHA256SUMS").decode('ascii')
         ret = {}
         for L in M.splitlines():
             H, N = L.split(None,1)
             if N.startswith('./'):
                 N = N[2:]
             ret[N] = {'name':N,'sha256':H}
-        return self.Manifest(self, ret, prefix)
+        return ret
 
     def section(self, arch, name):
+        from debian.deb822 import Packages
+        self._ensure_release()
         if name not in self.components:
             raise ValueError("Invalid components name '%s'"%name)
         if arch=='source':
@@ -300,7 +458,14 @@ class Archive(object):
             fullname = fname+suf
             if fullname not in self._top:
                 continue
-            with self._top.getfile(fullname) as F:
+            with self._top.getfile(fullname) as F, TemporaryFile() as T:
+                if suf:
+                    # apt_pkg reads from fileno(), which the decompressors
+                    # pass through from the compressed file
+                    with DECOMP[suf](F) as Z:
+                        copyfileobj(Z, T)
+                    T.seek(0)
+                    F = T
                 info = {}
                 for pkg in Packages.iter_paragraphs(F, use_apt_pkg=True):
                     info[pkg['Package']] = pkg